@@ -1,21 +1,50 @@
-import os
 import re
 import yaml
 import time
 import json
+import hashlib
+import functools
 import httpx
 import asyncio
 import logging
 import argparse
+import tempfile
+import contextlib
 from pathlib import Path
+from collections import Counter, defaultdict
 from slugify import slugify
 from datetime import datetime
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
+try:
+    import orjson
+    json_dumps, json_loads = orjson.dumps, orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+    json_loads = json.loads
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 # === Constants ===
 CHUNK_CHAR_LIMIT = 4000
 VERSION = 3
+HTTP_TIMEOUT = 120
+DEFAULT_MAX_INFLIGHT = {"openai": 16, "ollama": 2}
+DEFAULT_RPS = {"openai": 5.0, "ollama": None}
+YAML_DOC_SEPARATOR = re.compile(r"^---[ \t]*$", re.MULTILINE)
+CODE_FENCE_RE = re.compile(r"\A\s*```[\w-]*[ \t]*\n(.*?)\n?```\s*\Z", re.DOTALL)
+SIMPLE_STEM_RE = re.compile(r"[A-Za-z0-9 ._-]*")
+SLUG_SEPARATOR_RE = re.compile(r"[^a-z0-9]+")
+CACHE_STATS = {"hits": 0, "misses": 0, "shared": 0}
+INFLIGHT = {}
+SAVED = Counter()
+PART_LOCKS = defaultdict(asyncio.Lock)
 logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.INFO)
+_log = logging.getLogger(__name__)
 
 # === System Prompts ===
 
@@ -44,7 +73,7 @@ If skill is grounded, include context. Return only valid YAML.
 
 # === Prompt Generator ===
 
-def generate_prompt(mode, chunk, args):
+def _build_prompt_header(mode, args):
     if mode == "knowledge":
         return f"""{SYSTEM_PROMPT_KNOWLEDGE}
 
@@ -52,7 +81,6 @@ Domain: {args.domain}
 Created By: {args.created_by}
 
 ---
-{chunk}
 """
     elif mode == "skill":
         skill_type = "grounded" if args.grounded else "ungrounded"
@@ -63,100 +91,319 @@ Created By: {args.created_by}
 Task: {args.task or 'Unnamed'}
 
 ---
-{chunk}
 """
     raise ValueError("Invalid mode")
 
+def generate_prompt(mode, chunk, args):
+    return f"{_build_prompt_header(mode, args)}{chunk}\n"
+
+def generate_batch_prompt(header, chunks):
+    sections = "\n".join(f"### CHUNK {k}\n{chunk}\n" for k, chunk in enumerate(chunks, 1))
+    return (
+        f"{header}The text below contains {len(chunks)} chunks marked '### CHUNK n'. "
+        f"Return exactly {len(chunks)} YAML documents, one per chunk and in the same order, "
+        f"separated by lines containing only ---.\n\n{sections}"
+    )
+
+def batch_prompt_limit(header, args):
+    if args.batch_context_tokens:
+        return len(header) + args.batch_context_tokens * 4
+    # default: room for batch_chunks full-size chunks plus the batch markers
+    overhead = len(generate_batch_prompt(header, [""] * args.batch_chunks))
+    return overhead + args.batch_chunks * args.max_tokens * 4
+
+def group_chunks(chunks, batch_size, header, max_prompt_chars):
+    groups, current, start = [], [], 0
+    for i, chunk in enumerate(chunks):
+        if current and (
+            len(current) >= batch_size
+            or len(generate_batch_prompt(header, current + [chunk])) > max_prompt_chars
+        ):
+            groups.append((start, current))
+            current = []
+        if not current:
+            start = i
+        current.append(chunk)
+    if current:
+        groups.append((start, current))
+    return groups
+
 # === File Helpers ===
 
-def read_file(path):
-    return Path(path).read_text(encoding="utf-8")
+async def read_file(path):
+    return await asyncio.to_thread(Path(path).read_text, encoding="utf-8")
 
-def write_file(path, content):
+async def _write_text(path, content):
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(content, encoding="utf-8")
-    logging.info(f"✅ Saved: {path}")
+    await asyncio.to_thread(path.write_text, content, encoding="utf-8")
 
-def write_attribution(source_path, out_dir):
-    content = f"Source: {source_path.name}\nPath: {source_path.resolve()}\nLicense: Unknown"
-    write_file(out_dir / "attribution.txt", content)
+def _replace_text(path, content):
+    # write to a sibling temp file and rename it into place, so an interrupted run never leaves a truncated file
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, suffix=".tmp", delete=False) as f:
+        tmp_path = Path(f.name)
+        try:
+            f.write(content)
+        except BaseException:
+            f.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+    tmp_path.replace(path)
+
+async def _write_text_atomic(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    await asyncio.to_thread(_replace_text, path, content)
+
+async def write_file(path, content):
+    await _write_text(path, content)
+    SAVED[path.name] += 1
+    if _log.isEnabledFor(logging.INFO):
+        _log.info(f"✅ Saved: {path}")
+
+def attribution_text(source_path):
+    return f"Source: {source_path.name}\nPath: {source_path.resolve()}\nLicense: Unknown"
+
+async def write_attribution(content, out_dir):
+    path = out_dir / "attribution.txt"
+    if path.exists() and await read_file(path) == content:
+        return
+    await write_file(path, content)
+
+@functools.lru_cache(maxsize=4096)
+def _slug(stem):
+    # plain ASCII stems slugify identically without the unidecode/entity passes
+    if SIMPLE_STEM_RE.fullmatch(stem):
+        return SLUG_SEPARATOR_RE.sub("-", stem.lower()).strip("-")
+    return slugify(stem)
 
 def chunk_text(text, limit=CHUNK_CHAR_LIMIT):
-    parts, current, total = [], [], 0
-    for line in text.splitlines():
-        line_len = len(line)
-        if total + line_len > limit:
-            parts.append("\n".join(current))
-            current, total = [], 0
-        current.append(line)
-        total += line_len
-    if current:
-        parts.append("\n".join(current))
+    lines = text.split("\n")
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line) + 1)
+
+    parts, start, n = [], 0, len(lines)
+    while start < n:
+        line_len = offsets[start + 1] - offsets[start] - 1
+        if line_len > limit:
+            line = lines[start]
+            for j in range(0, line_len, limit):
+                piece = line[j:j + limit]
+                if piece.strip():
+                    parts.append(piece)
+            start += 1
+            continue
+        end = start + 1
+        while end < n and offsets[end + 1] - offsets[start] - 1 <= limit:
+            end += 1
+        part = text[offsets[start]:offsets[end] - 1]
+        if part.strip():
+            parts.append(part)
+        start = end
     return parts
 
+# === Rate Limiting ===
+
+class TokenBucket:
+    def __init__(self, rps):
+        self.rps = rps
+        self.capacity = max(1.0, rps)
+        self.tokens = self.capacity
+        self._lock = asyncio.Lock()
+        self._ts = time.monotonic()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._ts) * self.rps)
+                self._ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rps)
+
+class RequestLimiter:
+    def __init__(self, max_inflight, rps=None):
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.bucket = TokenBucket(rps) if rps else None
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        # take the rate token first so requests waiting on it don't hold an in-flight slot
+        if self.bucket is not None:
+            await self.bucket.acquire()
+        async with self.semaphore:
+            yield
+
+# === Response Cache ===
+
+def _cache_key(prompt, model, provider):
+    return hashlib.sha256(f"{VERSION}|{provider}|{model}|{prompt}".encode("utf-8")).hexdigest()
+
+def _cache_path(args, key):
+    return Path(args.cache_dir) / key[:2] / f"{key}.yaml"
+
+def split_yaml_documents(output):
+    return [doc.strip() + "\n" for doc in YAML_DOC_SEPARATOR.split(output) if doc.strip()]
+
+def strip_code_fence(output):
+    match = CODE_FENCE_RE.match(output)
+    return match.group(1) + "\n" if match else output
+
+def validate_yaml(output, expected_docs=1):
+    if expected_docs == 1:
+        yaml.load(output, Loader=YamlLoader)
+        return output
+    docs = split_yaml_documents(output)
+    if len(docs) != expected_docs:
+        raise yaml.YAMLError(f"expected {expected_docs} documents, got {len(docs)}")
+    for doc in docs:
+        yaml.load(doc, Loader=YamlLoader)
+    return output
+
+async def _cached_call_model(key, client, prompt, args, limiter, expected_docs):
+    if args.no_cache:
+        output = await call_model(client, prompt, args.model, args.provider, limiter)
+        return validate_yaml(strip_code_fence(output), expected_docs)
+    path = _cache_path(args, key)
+    if path.exists():
+        CACHE_STATS["hits"] += 1
+        return await read_file(path)
+    CACHE_STATS["misses"] += 1
+    output = strip_code_fence(await call_model(client, prompt, args.model, args.provider, limiter))
+    output = validate_yaml(output, expected_docs)
+    await _write_text_atomic(path, output)
+    return output
+
+async def cached_call_model(client, prompt, args, limiter, expected_docs=1):
+    # identical prompts (e.g. boilerplate repeated across files) share one model call
+    key = _cache_key(prompt, args.model, args.provider)
+    task = INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_cached_call_model(key, client, prompt, args, limiter, expected_docs))
+        INFLIGHT[key] = task
+
+        def _release(t):
+            # failures are retried by later duplicates; with the disk cache on, so are successes (as cache hits)
+            if t.cancelled() or t.exception() is not None or not args.no_cache:
+                INFLIGHT.pop(key, None)
+        task.add_done_callback(_release)
+    else:
+        CACHE_STATS["shared"] += 1
+    return await asyncio.shield(task)
+
 # === LLM Handlers ===
 
 @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=5, max=20))
-async def call_openai(prompt, model):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.3,
-            },
-            timeout=120,
-        )
+async def call_openai(client, prompt, model, limiter):
+    buf = []
+    async with limiter.slot(), client.stream(
+        "POST",
+        "https://api.openai.com/v1/chat/completions",
+        content=json_dumps({
+            "model": model,
+            "messages": [
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.3,
+            "stream": True,
+        }),
+    ) as response:
         response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            delta = json_loads(data)["choices"][0]["delta"]
+            if delta.get("content"):
+                buf.append(delta["content"])
+    return "".join(buf)
 
 @retry(stop=stop_after_attempt(3), wait=wait_random_exponential(min=5, max=20))
-async def call_ollama(prompt, model):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "http://localhost:11434/api/chat",
-            json={
-                "model": model,
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": False
-            },
-            timeout=120
-        )
+async def call_ollama(client, prompt, model, limiter):
+    buf = []
+    async with limiter.slot(), client.stream(
+        "POST",
+        "http://localhost:11434/api/chat",
+        content=json_dumps({
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": True
+        }),
+    ) as response:
         response.raise_for_status()
-        return response.json()["message"]["content"]
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            obj = json_loads(line)
+            buf.append(obj["message"]["content"])
+            if obj.get("done"):
+                break
+    return "".join(buf)
 
-async def call_model(prompt, model, provider):
+async def call_model(client, prompt, model, provider, limiter):
     if provider == "openai":
-        return await call_openai(prompt, model)
+        return await call_openai(client, prompt, model, limiter)
     elif provider == "ollama":
-        return await call_ollama(prompt, model)
+        return await call_ollama(client, prompt, model, limiter)
     raise ValueError("Unsupported provider")
 
+# === HTTP Client ===
+
+def build_client(args):
+    headers = {"Content-Type": "application/json"}
+    if args.provider == "openai":
+        headers["Authorization"] = f"Bearer {args.api_key}"
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=args.max_inflight),
+    )
+
 # === Processor ===
 
-async def process_file(file_path, args, semaphore):
-    async with semaphore:
+async def process_file(file_path, args, client, limiter):
+    if _log.isEnabledFor(logging.INFO):
+        _log.info(f"📄 Processing: {file_path}")
+    content = await read_file(file_path)
+    header = _build_prompt_header(args.mode, args)
+    chunks = chunk_text(content, limit=args.max_tokens * 4)
+    attribution = attribution_text(file_path)
+
+    async def _write_part(i, output):
+        subname = f"{_slug(file_path.stem)}-part-{i+1}"
+        out_path = Path(args.output_dir) / args.mode / args.domain / subname / "qna.yaml"
+        # files with the same stem share part directories; keep each qna.yaml/attribution.txt pair from one writer
+        async with PART_LOCKS[out_path.parent]:
+            await asyncio.gather(
+                write_file(out_path, output),
+                write_attribution(attribution, out_path.parent),
+            )
+
+    async def _do_group(start, group):
+        label = f"chunk {start+1}" if len(group) == 1 else f"chunks {start+1}-{start+len(group)}"
         try:
-            logging.info(f"📄 Processing: {file_path}")
-            content = read_file(file_path)
-            chunks = chunk_text(content, limit=args.max_tokens * 4)
-            for i, chunk in enumerate(chunks):
-                prompt = generate_prompt(args.mode, chunk, args)
-                output = await call_model(prompt, args.model, args.provider)
-                subname = f"{slugify(file_path.stem)}-part-{i+1}"
-                out_path = Path(args.output_dir) / args.mode / args.domain / subname / "qna.yaml"
-                write_file(out_path, output)
-                write_attribution(file_path, out_path.parent)
+            if len(group) == 1:
+                prompt = f"{header}{group[0]}\n"
+                outputs = [await cached_call_model(client, prompt, args, limiter)]
+            else:
+                prompt = generate_batch_prompt(header, group)
+                output = await cached_call_model(client, prompt, args, limiter, expected_docs=len(group))
+                outputs = split_yaml_documents(output)
+            await asyncio.gather(*(_write_part(start + k, output) for k, output in enumerate(outputs)))
+            return 0
+        except yaml.YAMLError as e:
+            logging.error(f"❌ Invalid YAML for {file_path.name} {label}: {e}")
         except Exception as e:
-            logging.error(f"❌ Error processing {file_path.name} chunk {i+1}: {e}")
+            logging.error(f"❌ Error processing {file_path.name} {label}: {e}")
+        return len(group)
+
+    groups = group_chunks(chunks, args.batch_chunks, header, batch_prompt_limit(header, args))
+    failed = await asyncio.gather(*(_do_group(start, group) for start, group in groups))
+    return sum(failed), len(chunks)
 
 # === Main CLI ===
 
@@ -173,21 +420,61 @@ async def main():
     parser.add_argument("--task", help="Skill task description")
     parser.add_argument("--grounded", action="store_true", help="Use grounded format for skill")
     parser.add_argument("--max-tokens", type=int, default=8000)
-    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--max-inflight", "--concurrency", dest="max_inflight", type=int,
+                        help="Max requests sent to the model at once, also the HTTP connection pool size "
+                             "(default: 16 for openai, 2 for ollama)")
+    parser.add_argument("--rps", type=float, help="Max model requests per second (default: 5 for openai, unlimited for ollama)")
+    parser.add_argument("--batch-chunks", type=int, default=1,
+                        help="Send up to N chunks of a file in one request (for large-context models)")
+    parser.add_argument("--batch-context-tokens", type=int,
+                        help="Prompt budget for a batched request, in tokens "
+                             "(default: room for --batch-chunks full chunks of --max-tokens each)")
+    parser.add_argument("--cache-dir", default=".llm_cache", help="Directory for cached LLM responses")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the model, ignoring the response cache")
+    parser.add_argument("--verbose", action="store_true", help="Log every processed and saved file")
     args = parser.parse_args()
 
+    # per-file and per-request lines only when asked for; run summaries are always shown
+    per_file_level = logging.INFO if args.verbose else logging.WARNING
+    _log.setLevel(per_file_level)
+    logging.getLogger("httpx").setLevel(per_file_level)
+
     if args.provider == "openai":
         if not args.api_key:
             raise ValueError("❌ You must provide --api-key for OpenAI.")
-        os.environ["OPENAI_API_KEY"] = args.api_key
 
     files = list(Path(args.input_dir).rglob("*.md"))
     if not files:
         logging.warning("⚠️ No markdown files found.")
         return
 
-    sem = asyncio.Semaphore(args.concurrency)
-    await asyncio.gather(*(process_file(f, args, sem) for f in files))
+    if args.max_inflight is None:
+        args.max_inflight = DEFAULT_MAX_INFLIGHT[args.provider]
+    rps = args.rps if args.rps is not None else DEFAULT_RPS[args.provider]
+    limiter = RequestLimiter(args.max_inflight, rps)
+    async with build_client(args) as client:
+        results = await asyncio.gather(
+            *(process_file(f, args, client, limiter) for f in files),
+            return_exceptions=True,
+        )
+
+    failures, failed_chunks = 0, 0
+    for f, result in zip(files, results):
+        if isinstance(result, BaseException):
+            failures += 1
+            logging.error(f"❌ Error processing {f.name}: {result!r}")
+            continue
+        failed, total = result
+        failed_chunks += failed
+        if failed and failed == total:
+            failures += 1
+    logging.info(f"🏁 Done: {len(files) - failures} files ok, {failures} failed, {failed_chunks} chunks failed")
+    logging.info(f"💾 Saved {SAVED['qna.yaml']} qna.yaml and {SAVED['attribution.txt']} attribution.txt files")
+
+    if not args.no_cache:
+        logging.info(f"🗃️ Cache: {CACHE_STATS['hits']} hits, {CACHE_STATS['misses']} misses")
+    if CACHE_STATS["shared"]:
+        logging.info(f"♻️ Reused {CACHE_STATS['shared']} duplicate chunk responses")
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,12 +1,13 @@
 import os
 import argparse
 import logging
-from utils import setup_logging, extract_tarball, process_html_files
+from utils import setup_logging, process_tarball
 
 def main():
     parser = argparse.ArgumentParser(description="Extract .txt and .md from .html files with metadata.")
     parser.add_argument("tarball", help="Path to the website tarball")
     parser.add_argument("-o", "--output", default=".", help="Directory to extract and process")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes for HTML conversion (default: CPU count)")
     args = parser.parse_args()
 
     setup_logging()
@@ -16,8 +17,7 @@ def main():
         return 1
 
     try:
-        extract_tarball(args.tarball, args.output)
-        count = process_html_files(args.output)
+        count = process_tarball(args.tarball, args.output, jobs=args.jobs)
 
         if count == 0:
             logging.warning("⚠️ No HTML files were processed.")
@@ -1,9 +1,10 @@
 import os
 import tarfile
 import logging
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from urllib.parse import urljoin
 import html
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 def setup_logging():
     logging.basicConfig(
@@ -11,36 +12,48 @@ def setup_logging():
         format='[%(asctime)s] %(levelname)s - %(message)s'
     )
 
-def extract_tarball(tar_path, extract_to):
-    try:
-        with tarfile.open(tar_path, 'r:*') as tar:
-            tar.extractall(path=extract_to)
-        logging.info(f"Extracted tarball to: {extract_to}")
-    except Exception as e:
-        logging.error(f"Error extracting tarball: {e}")
-        raise
+_QUOTE_TABLE = str.maketrans({'"': "'"})
+
+# tarfile extraction filters exist on 3.12+ (and security backports of 3.8-3.11)
+_EXTRACT_KWARGS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
 
-def extract_html_metadata(html_path, soup):
-    title_tag = soup.title.string.strip() if soup.title and soup.title.string else "Untitled"
+def _is_html_name(name):
+    return name.lower().endswith('.html') and not name.startswith('._')
+
+def extract_html_metadata(html_path, tree):
+    title_node = tree.css_first('title')
+    title_tag = title_node.text(strip=True) if title_node else ""
+    title_tag = title_tag or "Untitled"
     slug = os.path.splitext(os.path.basename(html_path))[0]
     rel_path = os.path.relpath(html_path)
     return title_tag, slug, rel_path
 
-def extract_text_and_links(html_path):
+def extract_text_and_links(html_path, html_bytes=None):
     try:
-        with open(html_path, 'r', encoding='utf-8', errors='ignore') as f:
-            soup = BeautifulSoup(f, 'html.parser')
-            title, slug, source = extract_html_metadata(html_path, soup)
-            text = soup.get_text(separator='\n', strip=True)
-
-            links = []
-            for a in soup.find_all('a', href=True):
-                href = a['href'].strip()
-                link_text = a.get_text(strip=True)
-                if href and not href.startswith('#'):
-                    links.append(f"- [{link_text or href}]({href})")
-
-            return title, slug, source, text, links
+        if html_bytes is None:
+            with open(html_path, 'r', encoding='utf-8', errors='ignore') as f:
+                markup = f.read()
+        else:
+            markup = html_bytes.decode('utf-8', errors='ignore')
+
+        tree = LexborHTMLParser(markup)
+        title, slug, source = extract_html_metadata(html_path, tree)
+        tree.strip_tags(['script', 'style'])
+        root = tree.root
+        # strip each text node and skip empty ones, like bs4's get_text(separator='\n', strip=True)
+        text_nodes = root.traverse(include_text=True) if root else ()
+        pieces = (node.text_content.strip() for node in text_nodes if node.tag == '-text')
+        text = '\n'.join(piece for piece in pieces if piece)
+
+        links = []
+        links_append = links.append
+        for a in tree.css('a[href]'):
+            href = (a.attributes.get('href') or '').strip()
+            if href and href[:1] != '#':
+                link_text = a.text(strip=True)
+                links_append(f"- [{link_text or href}]({href})")
+
+        return title, slug, source, text, links
     except Exception as e:
         logging.error(f"Error processing {html_path}: {e}")
         return "Untitled", "unknown", html_path, "", []
@@ -50,8 +63,8 @@ def write_outputs(html_path, title, slug, source, text, links):
     txt_path = base_name + ".txt"
     md_path = base_name + ".md"
 
-    title = html.escape(title.replace('"', "'"))
-    slug = html.escape(slug.replace('"', "'"))
+    title = html.escape(title.translate(_QUOTE_TABLE))
+    slug = html.escape(slug.translate(_QUOTE_TABLE))
 
     frontmatter = f"""---
 title: "{title}"
@@ -74,25 +87,50 @@ source: "{source}"
     except Exception as e:
         logging.error(f"Failed to write output files for {html_path}: {e}")
 
-def process_html_files(root_dir):
-    count = 0
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if not file.lower().endswith('.html') or file.startswith('._') or file == '.DS_Store':
-                continue
-
-            html_path = os.path.join(subdir, file)
-            title, slug, source, text, links = extract_text_and_links(html_path)
+def _process_bytes(html_bytes, html_path):
+    title, slug, source, text, links = extract_text_and_links(html_path, html_bytes)
+    if not text.strip():
+        return 0
 
-            if text.strip():
-                write_outputs(html_path, title, slug, source, text, links)
-                count += 1
+    os.makedirs(os.path.dirname(html_path) or '.', exist_ok=True)
+    write_outputs(html_path, title, slug, source, text, links)
+    return 1
 
-            try:
-                os.remove(html_path)
-            except Exception as e:
-                logging.warning(f"Could not remove {html_path}: {e}")
+def process_tarball(tar_path, extract_to, jobs=None):
+    pending = set()
+    count = 0
+    ex = ProcessPoolExecutor(max_workers=jobs) if jobs != 1 else None
+    # bound how much HTML is held in memory waiting for a worker
+    max_pending = 2 * (jobs or os.cpu_count() or 1)
+    try:
+        with tarfile.open(tar_path, 'r:*') as tar:
+            for member in tar:
+                if member.isfile() and _is_html_name(os.path.basename(member.name)):
+                    if _EXTRACT_KWARGS:
+                        try:
+                            member = tarfile.data_filter(member, extract_to)
+                        except tarfile.FilterError as e:
+                            logging.warning(f"Skipping unsafe tar member {member.name}: {e}")
+                            continue
+                    html_bytes = tar.extractfile(member).read()
+                    html_path = os.path.join(extract_to, member.name)
+                    if ex is None:
+                        count += _process_bytes(html_bytes, html_path)
+                    else:
+                        pending.add(ex.submit(_process_bytes, html_bytes, html_path))
+                        if len(pending) >= max_pending:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            count += sum(f.result() for f in done)
+                else:
+                    tar.extract(member, path=extract_to, **_EXTRACT_KWARGS)
+        logging.info(f"Extracted tarball to: {extract_to}")
+        count += sum(f.result() for f in pending)
+    except Exception as e:
+        logging.error(f"Error extracting tarball: {e}")
+        raise
+    finally:
+        if ex is not None:
+            ex.shutdown()
 
     logging.info(f"✅ Processed {count} HTML files.")
     return count
-